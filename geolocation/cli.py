@@ -0,0 +1,394 @@
+"""Command line entry point for batch solving of measurement files."""
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import functools
+import sys
+import time
+import numpy as np
+from .solver import kernels, solver, system
+from .utils import constants, io, error_handling, earth_model
+
+MODES = ['tdoa', 'tfdoa', 'wls', 'robust']
+# Modes with a solution algorithm in Solver. The others are reported as not
+# yet implemented before any measurements are read.
+IMPLEMENTED_MODES = ['tdoa']
+OUTPUT_COLUMNS = ['fix_id', 'solution', 'x', 'y', 'z', 'latitude', 'longitude', 'h', 'r1', 'residual']
+
+
+def get_parser():
+    """
+    Build the argument parser for the `geolocation` command.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog = 'geolocation',
+        description = "Solve for emitter locations from a file of TDoA/FDoA measurements.")
+    parser.add_argument('measurements',
+        help = "CSV of measurements, one fix per row. Columns TDoA_1..TDoA_(n-1) "
+               "(and FDoA_1..FDoA_(n-1) for T/FDoA) relative to the first satellite, "
+               "optional fix_id and r_emitter (m).")
+    parser.add_argument('ephemeris',
+        help = "CSV of satellite positions (r,latitude,longitude or x,y,z) and "
+               "optionally velocities (vx,vy,vz), one row per satellite. If a "
+               "fix_id column is given, the geometry is taken per fix.")
+    parser.add_argument('--mode', choices = MODES, default = 'tdoa',
+        help = "Solution algorithm (default: tdoa). Only tdoa is implemented "
+               "so far.")
+    parser.add_argument('--r-emitter', type = float, default = None,
+        help = "Known emitter distance from origin (m), used where the "
+               "measurements have no r_emitter column.")
+    parser.add_argument('--terrain', default = None,
+        help = "Directory of terrain height tiles (.npy). If given, the emitter "
+               "is constrained to the terrain surface.")
+    parser.add_argument('--geoid', default = None,
+        help = "Directory of geoid height tiles (.npy), if the terrain heights "
+               "are relative to the geoid.")
+    parser.add_argument('--scale-distance', type = float, default = None,
+        help = "Factor converting ephemeris distances to meters.")
+    parser.add_argument('--scale-velocity', type = float, default = None,
+        help = "Factor converting ephemeris velocities to m/s.")
+    parser.add_argument('--workers', type = int, default = 1,
+        help = "Number of worker processes (default: 1, in-process).")
+    parser.add_argument('--batch-size', type = int, default = 256,
+        help = "Number of fixes read and solved per task (default: 256).")
+    parser.add_argument('-o', '--output', default = None,
+        help = "Output CSV path (default: stdout).")
+    parser.add_argument('--chunk-size', type = int, default = 10000,
+        help = "Number of solution rows buffered before being written "
+               "out (default: 10000).")
+
+    return parser
+
+
+def load_ephemeris(ephemeris):
+    """
+    Load the satellite ephemeris.
+
+    Args:
+        ephemeris: Path to the satellite ephemeris CSV.
+    Returns:
+        is_geographic_coords: Indicate if the satellite positions are given in
+            geographic coordinates (r, latitude, longitude).
+        geometry: Function of fix_id, returning the satellite positions and
+            velocities (None if not given) for that fix.
+    """
+
+    return ephemeris_geometry(io.load_csv_generic(ephemeris))
+
+
+def ephemeris_geometry(eph):
+    """
+    Satellite geometry from a DataFrame of ephemeris, as load_ephemeris.
+    """
+
+    is_geographic_coords = {'r','latitude','longitude'}.issubset(eph.columns)
+    if is_geographic_coords:
+        pos_cols = ['r','latitude','longitude']
+    elif {'x','y','z'}.issubset(eph.columns):
+        pos_cols = ['x','y','z']
+    else:
+        raise error_handling.InsufficientDataError(
+            "Ephemeris must contain satellite positions as r,latitude,longitude or x,y,z.")
+    vel_cols = ['vx','vy','vz']
+    has_velocities = set(vel_cols).issubset(eph.columns)
+
+    def _geometry(df):
+        positions = np.array(df[pos_cols], dtype = float)
+        velocities = np.array(df[vel_cols], dtype = float) if has_velocities else None
+        return positions, velocities
+
+    if 'fix_id' in eph.columns:
+        per_fix = {fix_id: _geometry(df) for fix_id, df in eph.groupby('fix_id', sort = False)}
+
+        def geometry(fix_id):
+            if fix_id not in per_fix:
+                raise error_handling.InsufficientDataError(f"No ephemeris for fix_id {fix_id}.")
+            return per_fix[fix_id]
+    else:
+        static = _geometry(eph)
+        geometry = lambda fix_id: static
+
+    return is_geographic_coords, geometry
+
+
+def make_batch(df,
+                geometry,
+                mode = 'tdoa',
+                r_emitter = None,
+                first_fix_id = 0):
+    """
+    Pair each measurement (row of df) with its satellite geometry.
+
+    Args:
+        df: DataFrame of measurements, as described for the measurements file.
+        geometry: Function of fix_id returning the satellite geometry, as
+            returned by load_ephemeris.
+        mode: Solve mode, one of MODES.
+        r_emitter: Default emitter distance from origin (m).
+        first_fix_id: fix_id of the first row, if df has no fix_id column.
+    Returns:
+        List of fixes, where each fix is
+            (fix_id, positions, velocities, tdoa, fdoa, r_emitter). positions
+            is None for a fix with no ephemeris, which solve_batch counts as
+            failed.
+    """
+
+    tdoa_cols = [c for c in df.columns if c.startswith('TDoA')]
+    fdoa_cols = [c for c in df.columns if c.startswith('FDoA')]
+    if not tdoa_cols:
+        raise error_handling.InsufficientDataError("Measurements contain no TDoA columns.")
+    if mode == 'tfdoa' and not fdoa_cols:
+        raise error_handling.InsufficientDataError("T/FDoA solution requires FDoA columns.")
+
+    fix_ids = df['fix_id'].to_list() if 'fix_id' in df.columns else range(first_fix_id, first_fix_id + len(df))
+    tdoa = np.array(df[tdoa_cols], dtype = float)
+    fdoa = np.array(df[fdoa_cols], dtype = float) if mode == 'tfdoa' else None
+    if 'r_emitter' in df.columns:
+        r = np.array(df['r_emitter'], dtype = float)
+    else:
+        r = np.full(len(df), np.nan if r_emitter is None else r_emitter)
+
+    batch = []
+    for i, fix_id in enumerate(fix_ids):
+        try:
+            positions, velocities = geometry(fix_id)
+        except error_handling.InsufficientDataError:
+            positions, velocities = None, None
+        batch.append((fix_id, positions, velocities, tdoa[i],
+                      None if fdoa is None else fdoa[i],
+                      None if np.isnan(r[i]) else r[i]))
+
+    return batch
+
+
+def iter_batches(measurements,
+                ephemeris,
+                batch_size,
+                mode = 'tdoa',
+                r_emitter = None):
+    """
+    Read the measurement file in batches of fixes, pairing each with its
+    satellite geometry.
+
+    Args:
+        measurements: Path to the measurement CSV.
+        ephemeris: Path to the satellite ephemeris CSV.
+        batch_size: Number of fixes per batch.
+        mode: Solve mode, one of MODES.
+        r_emitter: Default emitter distance from origin (m).
+    Returns:
+        is_geographic_coords: Indicate if the satellite positions are given in
+            geographic coordinates (r, latitude, longitude).
+        batches: Generator of lists of fixes, as returned by make_batch.
+    """
+
+    is_geographic_coords, geometry = load_ephemeris(ephemeris)
+
+    def _batches():
+        n_read = 0
+        for df in io.iter_csv_chunks(measurements, chunksize = batch_size):
+            yield make_batch(df, geometry, mode = mode, r_emitter = r_emitter, first_fix_id = n_read)
+            n_read += len(df)
+
+    return is_geographic_coords, _batches()
+
+
+def tdoa_residual(sats, solution, tdoa):
+    """
+    Largest absolute difference (s) between the measured TDoA and the TDoA
+    implied by each solution.
+
+    Args:
+        sats: mx3 array of satellite positions [x,y,z] in meters.
+        solution: kx3 array of emitter positions [x,y,z] in meters.
+        tdoa: Length m TDoA relative to the first satellite (first element zero).
+    """
+
+    d = np.sqrt(np.sum((sats[np.newaxis,:,:] - solution[:,np.newaxis,:])**2, axis = 2))
+    tdoa_calc = (d - d[:,:1]) / constants.speed_of_light
+
+    return np.max(np.abs(tdoa_calc - np.asarray(tdoa)), axis = 1)
+
+
+def load_earth_model(terrain = None, geoid = None):
+    """
+    The earth model for the given terrain/geoid tile directories, or None
+    (a known r_emitter is used) if no terrain is given.
+    """
+
+    if terrain is None:
+        return None
+    geoid_model = earth_model.GriddedHeightModel(geoid) if geoid is not None else None
+
+    return earth_model.GriddedHeightModel(terrain, geoid = geoid_model)
+
+
+def solve_batch(batch,
+                mode,
+                is_geographic_coords,
+                scale_distance = None,
+                scale_velocity = None,
+                earth_model = None):
+    """
+    Solve each fix in a batch. Fixes that cannot be solved (e.g. no
+    ephemeris or r_emitter, or a number of satellites the Solver does not handle) are
+    counted as failed, rather than stopping the batch.
+
+    Returns:
+        rows: Solution rows, with columns as OUTPUT_COLUMNS.
+        latencies: Wall time (s) spent on each fix.
+        n_failed: Number of fixes for which no valid solution was found.
+    """
+
+    rows = []
+    latencies = []
+    n_failed = 0
+    for fix_id, positions, velocities, tdoa, fdoa, r_emitter in batch:
+        t0 = time.perf_counter()
+        try:
+            if positions is None:
+                raise error_handling.InsufficientDataError(f"No ephemeris for fix_id {fix_id}.")
+            syst = system.System(satellite_positions = positions,
+                                is_geographic_coords = is_geographic_coords,
+                                TDoA_data = tdoa,
+                                satellite_velocities = velocities,
+                                FDoA_data = fdoa,
+                                r_emitter = r_emitter,
+                                scale_distance = scale_distance,
+                                scale_velocity = scale_velocity if velocities is not None else None,
+                                earth_model = earth_model,
+                                verbose = False,
+                                )
+            s = solver.Solver(syst, verbose = False)
+            if mode == 'tdoa':
+                roots, solution = s.TDoA_solve()
+            else:
+                roots, solution = s.solve()
+        except (error_handling.InvalidSolutionError,
+                error_handling.UnknownCaseError,
+                error_handling.NotImplementedError,
+                error_handling.InsufficientDataError,
+                np.linalg.LinAlgError):
+            latencies.append(time.perf_counter() - t0)
+            n_failed += 1
+            continue
+
+        roots = np.real(roots)
+        solution = np.real(solution)
+        lat, lon, h = kernels.cartesian2geographic(x = solution[:,0], y = solution[:,1], z = solution[:,2])
+        residual = tdoa_residual(sats = np.array(syst.sat_data[['x','y','z']]),
+                                solution = solution,
+                                tdoa = syst.TDoA_data)
+        latencies.append(time.perf_counter() - t0)
+        for i, sol in enumerate(solution):
+            rows.append([fix_id, i, sol[0], sol[1], sol[2], lat[i], lon[i], h[i], roots[i], residual[i]])
+
+    return rows, latencies, n_failed
+
+
+def _bounded_map(executor, fn, iterable, max_pending):
+    """
+    Like executor.map, but only keeps max_pending tasks in flight so that the
+    input is consumed lazily. Results are yielded in input order.
+    """
+
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _print_summary(n_fixes, n_failed, n_solutions, wall_time, latencies, file):
+    """
+    Print the throughput/latency summary of a run.
+    """
+
+    print(f"Fixes: {n_fixes} ({n_failed} failed)", file = file)
+    print(f"Solutions: {n_solutions}", file = file)
+    print(f"Wall time: {wall_time:.3f} s", file = file)
+    if wall_time > 0:
+        print(f"Throughput: {n_fixes / wall_time:.1f} fixes/s", file = file)
+    if len(latencies):
+        lat_ms = np.array(latencies) * 1.e3
+        print(f"Latency per fix (ms): mean {np.mean(lat_ms):.3f}, "
+              f"p50 {np.percentile(lat_ms, 50):.3f}, "
+              f"p95 {np.percentile(lat_ms, 95):.3f}, "
+              f"max {np.max(lat_ms):.3f}", file = file)
+
+
+def run(args):
+    """
+    Run a batch solve for parsed command line arguments.
+    """
+
+    if args.mode not in IMPLEMENTED_MODES:
+        raise error_handling.NotImplementedError(f"The '{args.mode}' solver is not yet implemented")
+    if args.workers < 1 or args.batch_size < 1 or args.chunk_size < 1:
+        raise error_handling.UnknownCaseError("workers, batch-size and chunk-size must be positive.")
+
+    is_geographic_coords, batches = iter_batches(args.measurements,
+                                                args.ephemeris,
+                                                batch_size = args.batch_size,
+                                                mode = args.mode,
+                                                r_emitter = args.r_emitter)
+    worker = functools.partial(solve_batch,
+                                mode = args.mode,
+                                is_geographic_coords = is_geographic_coords,
+                                scale_distance = args.scale_distance,
+                                scale_velocity = args.scale_velocity,
+                                earth_model = load_earth_model(args.terrain, args.geoid))
+
+    out = open(args.output, 'w', newline = '') if args.output else sys.stdout
+    executor = None
+    try:
+        writer = csv.writer(out)
+        writer.writerow(OUTPUT_COLUMNS)
+        if args.workers > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers = args.workers)
+            results = _bounded_map(executor, worker, batches, max_pending = 2 * args.workers)
+        else:
+            results = map(worker, batches)
+
+        t0 = time.perf_counter()
+        latencies = []
+        n_failed = 0
+        n_solutions = 0
+        buffer = []
+        for rows, batch_latencies, batch_failed in results:
+            latencies.extend(batch_latencies)
+            n_failed += batch_failed
+            n_solutions += len(rows)
+            buffer.extend(rows)
+            if len(buffer) >= args.chunk_size:
+                writer.writerows(buffer)
+                out.flush()
+                buffer = []
+        writer.writerows(buffer)
+        out.flush()
+        wall_time = time.perf_counter() - t0
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if out is not sys.stdout:
+            out.close()
+
+    _print_summary(len(latencies), n_failed, n_solutions, wall_time, latencies, file = sys.stderr)
+
+
+def main(argv = None):
+    args = get_parser().parse_args(argv)
+    try:
+        run(args)
+    except (error_handling.NotImplementedError,
+            error_handling.UnknownCaseError,
+            error_handling.InsufficientDataError) as e:
+        print(f"geolocation: error: {e.message}", file = sys.stderr)
+        return 1
+
+    return 0
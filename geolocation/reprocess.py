@@ -0,0 +1,520 @@
+"""
+Memory-bounded reprocessing of large measurement files.
+
+Measurements are read in chunks sized to a memory budget, partitioned into
+time windows and solved one partition at a time. Solutions are appended to an
+on-disk store of memory-mapped .npy segments (one or more per time window),
+while per-emitter counts, mean positions and a residual histogram are
+accumulated as the job runs, so that the full set of results is never held in
+memory.
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from . import cli
+from .solver import lookup
+from .utils import conversion, earth_model, io, error_handling
+
+STORE_COLUMNS = ['time', 'emitter_id'] + cli.OUTPUT_COLUMNS
+
+# Rough working set (bytes) per fix held in memory while a chunk is being
+# solved: the measurement row, the fix tuple and up to four solution rows.
+BYTES_PER_FIX = 2048
+
+
+class ResultStore(object):
+    def __init__(self, directory):
+        """
+        Args:
+            directory: Directory holding the .npy segments. Created if it
+                        does not exist.
+        """
+
+        os.makedirs(directory, exist_ok = True)
+        if any(f.startswith('window_') for f in os.listdir(directory)):
+            raise error_handling.UnknownCaseError(f"Result store {directory} is not empty.")
+        self.directory = directory
+        self._n_segments = {}
+
+        with open(os.path.join(directory, 'columns.json'), 'w') as f:
+            json.dump(STORE_COLUMNS, f)
+
+
+    def append(self, window, rows):
+        """
+        Write rows (with columns as STORE_COLUMNS) to a new segment for the
+        given time window.
+        """
+
+        if len(rows) == 0:
+            return
+        seq = self._n_segments.get(window, 0)
+        filepath = os.path.join(self.directory, f"window_{window}_{seq:06d}.npy")
+        segment = np.lib.format.open_memmap(filepath, mode = 'w+', dtype = float,
+                                            shape = (len(rows), len(STORE_COLUMNS)))
+        segment[:] = rows
+        segment.flush()
+        del segment
+        self._n_segments[window] = seq + 1
+
+
+    @staticmethod
+    def iter_segments(directory, window = None):
+        """
+        Iterate over the segments of a store (optionally for a single time
+        window) as read-only memory-mapped arrays.
+        """
+
+        prefix = "window_" if window is None else f"window_{window}_"
+        for filename in sorted(os.listdir(directory)):
+            if filename.startswith(prefix) and filename.endswith('.npy'):
+                yield np.load(os.path.join(directory, filename), mmap_mode = 'r')
+
+
+class Aggregates(object):
+    def __init__(self,
+                residual_bins = None,
+                separation = 1.e3,
+                residual_floor = 1.e-15,
+                ):
+        """
+        Args:
+            residual_bins: Bin edges (s) of the residual histogram. Residuals
+                        outside the edges are counted in the first/last bin.
+            separation: A fix's best solution is only used for the mean
+                        positions if every other candidate's residual is at
+                        least this factor larger.
+            residual_floor: Residuals (s) below this are treated as
+                        numerical noise when comparing candidates.
+        """
+
+        if residual_bins is None:
+            residual_bins = np.logspace(-15, -6, 46)
+        self.residual_bins = np.asarray(residual_bins, dtype = float)
+        self.residual_hist = np.zeros(len(self.residual_bins) - 1, dtype = int)
+        self.separation = separation
+        self.residual_floor = residual_floor
+        self.counts = {}
+        self.n_ambiguous = {}
+        self._position_counts = {}
+        self._position_sums = {}
+
+
+    def update(self, rows):
+        """
+        Accumulate the best solution (smallest residual) of each fix in rows,
+        with columns as STORE_COLUMNS. Every fix counts towards the emitter
+        counts and the residual histogram. Only fixes whose best solution is
+        clearly separated from the other candidates count towards the mean
+        positions; the rest are counted in n_ambiguous.
+        """
+
+        if len(rows) == 0:
+            return
+        col = {c: i for i, c in enumerate(STORE_COLUMNS)}
+        rows = np.asarray(rows)
+        rows = rows[np.lexsort((rows[:,col['residual']], rows[:,col['fix_id']]))]
+        fix_ids = rows[:,col['fix_id']]
+        first = np.unique(fix_ids, return_index = True)[1]
+        best = rows[first]
+
+        # Residual of the second best candidate of each fix (inf if none)
+        second = np.full(len(first), np.inf)
+        next_row = np.minimum(first + 1, len(rows) - 1)
+        has_second = (first + 1 < len(rows)) & (fix_ids[next_row] == fix_ids[first])
+        second[has_second] = rows[next_row[has_second], col['residual']]
+        resolved = second > self.separation * np.maximum(best[:,col['residual']], self.residual_floor)
+
+        residual = np.clip(best[:,col['residual']], self.residual_bins[0], self.residual_bins[-1])
+        self.residual_hist += np.histogram(residual, bins = self.residual_bins)[0]
+
+        emitters, inverse = np.unique(best[:,col['emitter_id']], return_inverse = True)
+        inverse = np.ravel(inverse)
+        xyz = best[:,[col['x'], col['y'], col['z']]]
+        for i, emitter_id in enumerate(emitters):
+            members = inverse == i
+            positioned = members & resolved
+            self.counts[emitter_id] = self.counts.get(emitter_id, 0) + int(np.sum(members))
+            self.n_ambiguous[emitter_id] = self.n_ambiguous.get(emitter_id, 0) + int(np.sum(members & ~resolved))
+            if positioned.any():
+                self._position_counts[emitter_id] = self._position_counts.get(emitter_id, 0) + int(np.sum(positioned))
+                self._position_sums[emitter_id] = self._position_sums.get(emitter_id, 0.0) + np.sum(xyz[positioned], axis = 0)
+
+
+    def mean_positions(self):
+        """
+        Mean position [x,y,z] (m) of each emitter, over its fixes with an
+        unambiguous solution. Emitters with no such fix are omitted.
+        """
+
+        return {e: self._position_sums[e] / self._position_counts[e] for e in self._position_counts}
+
+
+class EphemerisReader(object):
+    def __init__(self, filepath, chunksize):
+        """
+        Reads the satellite ephemeris in step with the measurements. A static
+        ephemeris (no fix_id column, one row per satellite) is loaded once.
+        Per-fix ephemeris is read in chunks, and must list the fixes in the
+        same order as the measurements (fixes with no measurements are
+        skipped).
+
+        Args:
+            filepath: Path to the satellite ephemeris CSV.
+            chunksize: Number of rows to read at a time.
+        """
+
+        self._chunks = io.iter_csv_chunks(filepath, chunksize = chunksize)
+        first = next(self._chunks, None)
+        if first is None:
+            raise error_handling.InsufficientDataError("Ephemeris is empty.")
+
+        self.per_fix = 'fix_id' in first.columns
+        if self.per_fix:
+            self.is_geographic_coords, _ = cli.ephemeris_geometry(first)
+            self._buffer = first
+            self._exhausted = False
+        else:
+            eph = pd.concat([first] + list(self._chunks), ignore_index = True)
+            self.is_geographic_coords, self._static = cli.ephemeris_geometry(eph)
+
+
+    def geometry(self, fix_ids):
+        """
+        Geometry (as cli.load_ephemeris) for fix_ids, the next fixes in the
+        measurements. Per-fix ephemeris rows up to the last of these fixes are
+        consumed.
+        """
+
+        if not self.per_fix:
+            return self._static
+
+        last = fix_ids[-1]
+        # Read until the rows of the last fix are complete.
+        while not self._exhausted and (self._buffer.fix_id.iloc[-1] == last or
+                                       not (self._buffer.fix_id == last).any()):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._exhausted = True
+            else:
+                self._buffer = pd.concat([self._buffer, chunk], ignore_index = True)
+
+        matches = np.flatnonzero(np.asarray(self._buffer.fix_id == last))
+        if len(matches) == 0:
+            raise error_handling.InsufficientDataError(
+                f"No ephemeris for fix_id {last}. Per-fix ephemeris must be in the same order as the measurements.")
+        cut = matches[-1] + 1
+        eph = self._buffer.iloc[:cut]
+        self._buffer = self._buffer.iloc[cut:].reset_index(drop = True)
+        eph = eph[eph.fix_id.isin(fix_ids)]
+
+        return cli.ephemeris_geometry(eph)[1]
+
+
+class ReprocessingJob(object):
+    def __init__(self,
+                measurements,
+                ephemeris,
+                output_dir,
+                time_window,
+                memory_budget = 256 * 2**20,
+                mode = 'tdoa',
+                r_emitter = None,
+                scale_distance = None,
+                scale_velocity = None,
+                residual_bins = None,
+                index = None,
+                index_threshold = 1.e3,
+                earth_model = None,
+                ):
+        """
+        Args:
+            measurements: Path to the measurement CSV, as for the command line
+                        solver, with an additional time column and optionally
+                        an emitter_id column (numeric).
+            ephemeris: Path to the satellite ephemeris CSV.
+            output_dir: Directory of the result store.
+            time_window: Length of each time partition, in the units of the
+                        time column, or in seconds if the time column holds
+                        timestamps (e.g. ISO 8601).
+            memory_budget: Approximate working memory (bytes) for measurements,
+                        ephemeris and results held while solving. A warning
+                        is given if the resident set size grows by more than
+                        this during the job.
+            mode: Solve mode, one of cli.MODES.
+            r_emitter: Default emitter distance from origin (m).
+            scale_distance: If satellite coordinate data is not meters,
+                        provide a multiplying factor that will convert to meters.
+            scale_velocity: If satellite velocity is not m/s,
+                        provide a multiplying factor that will convert to m/s.
+            residual_bins: Bin edges (s) of the residual histogram.
+            index: Optional lookup.TDoAIndex. If given, it selects the solution
+                        of each fix used in the aggregates. Without it, only
+                        fixes whose candidates are separated by their
+                        residuals give mean positions, which excludes the
+                        three satellite TDoA solution.
+            index_threshold: Distance (m) a satellite of a fix may be from the
+                        index's geometry before the index is recomputed for
+                        the fix's geometry (see lookup.TDoAIndex.update). The
+                        index is updated in place.
+            earth_model: Optional earth_model.EarthModel constraining the
+                        emitter to its surface.
+        """
+
+        if time_window <= 0:
+            raise error_handling.UnknownCaseError("time_window must be positive.")
+        if mode not in cli.IMPLEMENTED_MODES:
+            raise error_handling.NotImplementedError(f"The '{mode}' solver is not yet implemented")
+
+        self.measurements = measurements
+        self.ephemeris = ephemeris
+        self.store = ResultStore(output_dir)
+        self.time_window = time_window
+        self.memory_budget = memory_budget
+        self.chunk_size = max(1, int(memory_budget // BYTES_PER_FIX))
+        self.mode = mode
+        self.r_emitter = r_emitter
+        self.scale_distance = scale_distance
+        self.scale_velocity = scale_velocity
+        self.aggregates = Aggregates(residual_bins = residual_bins)
+        self.index = index
+        self.index_threshold = index_threshold
+        self.earth_model = earth_model
+
+
+    def run(self):
+        """
+        Run the job.
+
+        Returns:
+            Summary of the job: number of fixes, failures and solutions, the
+            time windows processed, wall time, peak resident set size and its
+            increase during the job.
+        """
+
+        rss_start = peak_rss()
+        ephemeris = EphemerisReader(self.ephemeris, chunksize = self.chunk_size)
+
+        t0 = time.perf_counter()
+        n_read = 0
+        n_failed = 0
+        n_solutions = 0
+        windows = set()
+        for df in io.iter_csv_chunks(self.measurements, chunksize = self.chunk_size):
+            if 'time' not in df.columns:
+                raise error_handling.InsufficientDataError("Measurements must contain a time column.")
+            df['time'] = self._times(df['time'])
+            if 'fix_id' not in df.columns:
+                df['fix_id'] = np.arange(n_read, n_read + len(df))
+            n_read += len(df)
+            if 'emitter_id' not in df.columns:
+                df['emitter_id'] = -1
+            self._check_ids(df)
+
+            geometry = ephemeris.geometry(df['fix_id'].to_list())
+            window_ids = np.floor(np.asarray(df['time']) / self.time_window).astype(int)
+            for window in np.unique(window_ids):
+                part = df[window_ids == window]
+                batch = cli.make_batch(part, geometry, mode = self.mode, r_emitter = self.r_emitter)
+                rows, _, failed = cli.solve_batch(batch,
+                                                mode = self.mode,
+                                                is_geographic_coords = ephemeris.is_geographic_coords,
+                                                scale_distance = self.scale_distance,
+                                                scale_velocity = self.scale_velocity,
+                                                earth_model = self.earth_model)
+                rows = self._add_fix_info(rows, part)
+                self.store.append(int(window), rows)
+                self.aggregates.update(self._select(rows, batch, ephemeris.is_geographic_coords))
+                windows.add(int(window))
+                n_failed += failed
+                n_solutions += len(rows)
+
+        rss = peak_rss()
+        if rss - rss_start > self.memory_budget:
+            warnings.warn(f"Resident set size grew by {(rss - rss_start) / 2**20:.1f} MiB, "
+                          f"over the memory budget of {self.memory_budget / 2**20:.1f} MiB.")
+
+        return {
+            'fixes': n_read,
+            'failed': n_failed,
+            'solutions': n_solutions,
+            'windows': sorted(windows),
+            'wall_time': time.perf_counter() - t0,
+            'peak_rss': rss,
+            'rss_increase': rss - rss_start,
+        }
+
+
+    @staticmethod
+    def _times(time):
+        """
+        Numeric times are used as given. Otherwise the times are parsed as
+        timestamps, and converted to seconds since the Unix epoch (UTC).
+        """
+
+        if np.issubdtype(time.dtype, np.number):
+            return np.asarray(time, dtype = float)
+        try:
+            time = pd.to_datetime(time, utc = True)
+        except (ValueError, TypeError):
+            raise error_handling.InsufficientDataError(
+                "time must be numeric, or timestamps (e.g. ISO 8601) readable by pandas.")
+
+        return np.asarray((time - pd.Timestamp(0, tz = 'UTC')).dt.total_seconds(), dtype = float)
+
+
+    @staticmethod
+    def _check_ids(df):
+        """
+        The store holds fix_id and emitter_id as floats, and solutions are
+        matched to their fix by fix_id, so both must be numeric and fix_id
+        unique.
+        """
+
+        for c in ['fix_id', 'emitter_id']:
+            if not np.issubdtype(df[c].dtype, np.number):
+                raise error_handling.InsufficientDataError(f"{c} must be numeric for reprocessing.")
+        if not df['fix_id'].is_unique:
+            raise error_handling.InsufficientDataError("fix_id must be unique for reprocessing.")
+
+
+    def _add_fix_info(self, rows, part):
+        """
+        Prepend the time and emitter_id of each solution's fix to its row.
+        """
+
+        if len(rows) == 0:
+            return np.zeros((0, len(STORE_COLUMNS)))
+        rows = np.array(rows, dtype = float)
+        info = part.set_index('fix_id')[['time', 'emitter_id']].astype(float)
+        info.index = info.index.astype(float)
+        fix_info = np.array(info.loc[rows[:,0]])
+
+        return np.concatenate([fix_info, rows], axis = 1)
+
+
+    def _select(self, rows, batch, is_geographic_coords):
+        """
+        Rows to aggregate. Without an index, the aggregates pick the solution
+        with the smallest residual. With an index, only the solution closest
+        to the coarse fix is kept for each fix, after updating the index to
+        the satellite geometry of the fix.
+        """
+
+        if self.index is None or len(rows) == 0:
+            return rows
+
+        fix_col = STORE_COLUMNS.index('fix_id')
+        xyz = [STORE_COLUMNS.index(c) for c in ['x','y','z']]
+        selected = []
+        for fix_id, positions, _, tdoa, _, _ in batch:
+            candidates = rows[rows[:,fix_col] == fix_id]
+            if len(candidates) == 0:
+                continue
+            self.index.update(self._sat_positions(positions, is_geographic_coords), self.index_threshold)
+            position = self.index.select(candidates[:,xyz], tdoa)
+            selected.append(candidates[np.argmin(np.sum((candidates[:,xyz] - position)**2, axis = 1))])
+
+        return np.array(selected)
+
+
+    def _sat_positions(self, positions, is_geographic_coords):
+        """
+        Satellite positions [x,y,z] in meters, as converted by System.
+        """
+
+        positions = np.asarray(positions, dtype = float)
+        scale = 1.0 if self.scale_distance is None else self.scale_distance
+        if not is_geographic_coords:
+            return positions * scale
+
+        lat = positions[:,1]
+        lon = positions[:,2]
+        h = positions[:,0] * scale - earth_model.local_earth_radius(lat = lat, lon = lon)
+
+        return np.stack(conversion.geographic2cartesian(lat = lat, lon = lon, h = h), axis = 1)
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process, in bytes.
+    """
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog = 'python -m geolocation.reprocess',
+        description = "Reprocess a large measurement file with bounded memory.")
+    parser.add_argument('measurements', help = "CSV of measurements with a time column.")
+    parser.add_argument('ephemeris', help = "CSV of satellite positions/velocities.")
+    parser.add_argument('output_dir', help = "Directory for the result store.")
+    parser.add_argument('--time-window', type = float, required = True,
+        help = "Length of each time partition, in the units of the time column "
+               "(seconds if the time column holds timestamps).")
+    parser.add_argument('--memory-budget', type = float, default = 256,
+        help = "Working memory budget in MiB (default: 256).")
+    parser.add_argument('--mode', choices = cli.MODES, default = 'tdoa')
+    parser.add_argument('--r-emitter', type = float, default = None)
+    parser.add_argument('--terrain', default = None, help = "Directory of terrain height tiles (.npy).")
+    parser.add_argument('--geoid', default = None, help = "Directory of geoid height tiles (.npy).")
+    parser.add_argument('--scale-distance', type = float, default = None)
+    parser.add_argument('--scale-velocity', type = float, default = None)
+    parser.add_argument('--index', default = None,
+        help = "Lookup table (.npz) used to select between solutions.")
+    parser.add_argument('--index-threshold', type = float, default = 1.e3,
+        help = "Satellite drift (m) from the lookup table's geometry before the "
+               "table is recomputed (default: 1000).")
+    args = parser.parse_args(argv)
+
+    try:
+        job = ReprocessingJob(measurements = args.measurements,
+                            ephemeris = args.ephemeris,
+                            output_dir = args.output_dir,
+                            time_window = args.time_window,
+                            memory_budget = args.memory_budget * 2**20,
+                            mode = args.mode,
+                            r_emitter = args.r_emitter,
+                            scale_distance = args.scale_distance,
+                            scale_velocity = args.scale_velocity,
+                            index = lookup.TDoAIndex.load(args.index) if args.index else None,
+                            index_threshold = args.index_threshold,
+                            earth_model = cli.load_earth_model(args.terrain, args.geoid))
+        summary = job.run()
+    except (error_handling.NotImplementedError,
+            error_handling.UnknownCaseError,
+            error_handling.InsufficientDataError) as e:
+        print(f"geolocation: error: {e.message}", file = sys.stderr)
+        return 1
+
+    print(f"Fixes: {summary['fixes']} ({summary['failed']} failed)")
+    print(f"Solutions: {summary['solutions']} in {len(summary['windows'])} time window/s")
+    print(f"Wall time: {summary['wall_time']:.3f} s")
+    print(f"Peak RSS: {summary['peak_rss'] / 2**20:.1f} MiB "
+          f"(+{summary['rss_increase'] / 2**20:.1f} MiB during the job)")
+    mean_positions = job.aggregates.mean_positions()
+    for emitter_id, count in job.aggregates.counts.items():
+        n_ambiguous = job.aggregates.n_ambiguous[emitter_id]
+        if emitter_id in mean_positions:
+            print(f"Emitter {emitter_id:g}: {count} fixes, "
+                  f"mean position [x,y,z] {mean_positions[emitter_id]} m "
+                  f"({n_ambiguous} ambiguous fixes excluded)")
+        else:
+            print(f"Emitter {emitter_id:g}: {count} fixes, position ambiguous "
+                  f"(pass --index to select between solutions)")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
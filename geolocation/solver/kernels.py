@@ -0,0 +1,309 @@
+"""
+Kernels for the per-fix TDoA solve (three satellites, known r_emitter).
+
+All kernels operate on a batch of n fixes. A NumPy implementation is always
+available; if Numba can be imported, JIT-compiled equivalents are used instead,
+since for single fixes and small batches the NumPy versions are dominated by
+dispatch overhead rather than arithmetic.
+"""
+
+import numpy as np
+from ..utils import constants, conversion, earth_model
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAS_NUMBA = numba is not None
+
+
+# NumPy implementations.
+
+def _np_tdoa_G1_h(sats, tdoa, r_emitter):
+    """
+    Args:
+        sats: nx3x3 array of satellite positions [x,y,z] in meters.
+        tdoa: nx3 array of TDoA relative to the first satellite (first column zero).
+        r_emitter: Length n array of emitter distances from origin in meters.
+    Returns:
+        G1: nx3x3 array, as Solver.populate_G1.
+        h: nx3x3 array, as Solver.populate_h.
+    """
+    s1 = sats[:,0]
+    G1 = -2 * np.stack([s1, sats[:,1] - s1, sats[:,2] - s1], axis = 1)
+
+    ssq = np.sum(sats**2, axis = 2)
+    d = tdoa * constants.speed_of_light
+    h = np.zeros(sats.shape)
+    h[:,0,0] = -r_emitter**2 - ssq[:,0]
+    h[:,0,2] = 1.0
+    h[:,1:,0] = d[:,1:]**2 - ssq[:,1:] + ssq[:,:1]
+    h[:,1:,1] = 2 * d[:,1:]
+
+    return G1, h
+
+def _np_solve3(A, B):
+    """
+    Solve A X = B for each fix, where A is nx3x3 and B is nx3xk.
+    """
+    return np.linalg.solve(A, B)
+
+def _np_r1_coefficients(G1_inv_h, r_emitter):
+    """
+    Coefficients [c4, c3, c2, c1, c0] of the quartic in r1, as
+    Solver.get_r1_coefficients, for each fix.
+    """
+    a = G1_inv_h[:,:,0]
+    b = G1_inv_h[:,:,1]
+    c = G1_inv_h[:,:,2]
+    c0 = np.sum(a * a, axis = 1) - r_emitter**2
+    c1 = 2 * np.sum(a * b, axis = 1)
+    c2 = np.sum(b * b, axis = 1) + 2 * np.sum(a * c, axis = 1)
+    c3 = 2 * np.sum(b * c, axis = 1)
+    c4 = np.sum(c * c, axis = 1)
+
+    return np.stack([c4, c3, c2, c1, c0], axis = 1)
+
+def _np_quartic_roots(coeffs):
+    """
+    Roots of each quartic (nx5 coefficients, highest power first) as the
+    eigenvalues of the companion matrix, as np.roots.
+    """
+    n = len(coeffs)
+    companion = np.zeros((n, 4, 4))
+    companion[:,0,:] = -coeffs[:,1:] / coeffs[:,:1]
+    companion[:,1,0] = 1.0
+    companion[:,2,1] = 1.0
+    companion[:,3,2] = 1.0
+
+    return np.linalg.eigvals(companion).astype(complex)
+
+def _np_cartesian2geographic(x, y, z):
+    return conversion.cartesian2geographic(x = x, y = y, z = z)
+
+
+# Numba implementations. These follow the NumPy implementations above, but
+# loop explicitly over the fixes so that no temporaries are allocated.
+
+if HAS_NUMBA:
+
+    _jit = numba.njit(cache = True, error_model = 'numpy')
+
+    @_jit
+    def _nb_tdoa_G1_h(sats, tdoa, r_emitter):
+        n = sats.shape[0]
+        G1 = np.empty((n, 3, 3))
+        h = np.zeros((n, 3, 3))
+        for k in range(n):
+            s1sq = 0.0
+            for j in range(3):
+                s1sq += sats[k,0,j]**2
+            for j in range(3):
+                G1[k,0,j] = -2 * sats[k,0,j]
+            h[k,0,0] = -r_emitter[k]**2 - s1sq
+            h[k,0,2] = 1.0
+            for i in range(1, 3):
+                sisq = 0.0
+                for j in range(3):
+                    G1[k,i,j] = -2 * (sats[k,i,j] - sats[k,0,j])
+                    sisq += sats[k,i,j]**2
+                d = tdoa[k,i] * constants.speed_of_light
+                h[k,i,0] = d**2 - sisq + s1sq
+                h[k,i,1] = 2 * d
+
+        return G1, h
+
+    @_jit
+    def _nb_solve3(A, B):
+        n = A.shape[0]
+        m = B.shape[2]
+        X = np.empty((n, 3, m))
+        for k in range(n):
+            a = A[k].copy()
+            b = B[k].copy()
+            # Gaussian elimination with partial pivoting.
+            for col in range(3):
+                piv = col
+                for row in range(col + 1, 3):
+                    if abs(a[row,col]) > abs(a[piv,col]):
+                        piv = row
+                if piv != col:
+                    for j in range(3):
+                        tmp = a[col,j]
+                        a[col,j] = a[piv,j]
+                        a[piv,j] = tmp
+                    for j in range(m):
+                        tmp = b[col,j]
+                        b[col,j] = b[piv,j]
+                        b[piv,j] = tmp
+                for row in range(col + 1, 3):
+                    factor = a[row,col] / a[col,col]
+                    for j in range(col, 3):
+                        a[row,j] -= factor * a[col,j]
+                    for j in range(m):
+                        b[row,j] -= factor * b[col,j]
+            for row in range(2, -1, -1):
+                for j in range(m):
+                    acc = b[row,j]
+                    for i in range(row + 1, 3):
+                        acc -= a[row,i] * X[k,i,j]
+                    X[k,row,j] = acc / a[row,row]
+
+        return X
+
+    @_jit
+    def _nb_r1_coefficients(G1_inv_h, r_emitter):
+        n = G1_inv_h.shape[0]
+        coeffs = np.empty((n, 5))
+        for k in range(n):
+            aa = ab = bb = ac = bc = cc = 0.0
+            for i in range(3):
+                a = G1_inv_h[k,i,0]
+                b = G1_inv_h[k,i,1]
+                c = G1_inv_h[k,i,2]
+                aa += a * a
+                ab += a * b
+                bb += b * b
+                ac += a * c
+                bc += b * c
+                cc += c * c
+            coeffs[k,0] = cc
+            coeffs[k,1] = 2 * bc
+            coeffs[k,2] = bb + 2 * ac
+            coeffs[k,3] = 2 * ab
+            coeffs[k,4] = aa - r_emitter[k]**2
+
+        return coeffs
+
+    @_jit
+    def _nb_quartic_roots(coeffs):
+        # Durand-Kerner iteration on the monic quartic, rescaled by the
+        # Fujiwara bound so that the roots lie within the unit circle,
+        # followed by Newton polishing of each root.
+        n = coeffs.shape[0]
+        roots = np.empty((n, 4), dtype = np.complex128)
+        b = np.empty(4)
+        z = np.empty(4, dtype = np.complex128)
+        for k in range(n):
+            scale = 2 * max(abs(coeffs[k,1] / coeffs[k,0]),
+                            abs(coeffs[k,2] / coeffs[k,0])**(1 / 2),
+                            abs(coeffs[k,3] / coeffs[k,0])**(1 / 3),
+                            abs(0.5 * coeffs[k,4] / coeffs[k,0])**(1 / 4))
+            if scale == 0.0:
+                roots[k,:] = 0.0
+                continue
+            for i in range(4):
+                b[i] = coeffs[k,i+1] / coeffs[k,0] / scale**(i + 1)
+
+            seed = 0.4 + 0.9j
+            z[0] = 1.0
+            for i in range(1, 4):
+                z[i] = z[i-1] * seed
+            for _ in range(500):
+                max_step = 0.0
+                for i in range(4):
+                    p = (((z[i] + b[0]) * z[i] + b[1]) * z[i] + b[2]) * z[i] + b[3]
+                    denom = 1.0 + 0.0j
+                    for j in range(4):
+                        if j != i:
+                            denom *= z[i] - z[j]
+                    step = p / denom
+                    z[i] -= step
+                    max_step = max(max_step, abs(step))
+                if max_step < 1.e-15:
+                    break
+
+            for i in range(4):
+                for _ in range(3):
+                    p = (((z[i] + b[0]) * z[i] + b[1]) * z[i] + b[2]) * z[i] + b[3]
+                    dp = ((4 * z[i] + 3 * b[0]) * z[i] + 2 * b[1]) * z[i] + b[2]
+                    if dp == 0:
+                        break
+                    z[i] -= p / dp
+                if abs(z[i].imag) <= 1.e-12 * abs(z[i]):
+                    z[i] = z[i].real
+                roots[k,i] = z[i] * scale
+
+        return roots
+
+    @_jit
+    def _nb_cartesian2geographic(x, y, z):
+        r_e = earth_model.r_e
+        ecc2 = earth_model.ecc**2
+        f = 1 - np.sqrt(1 - ecc2)
+        n = x.shape[0]
+        lat = np.empty(n)
+        lon = np.empty(n)
+        h = np.empty(n)
+        for k in range(n):
+            r = np.sqrt(x[k]**2 + y[k]**2 + z[k]**2)
+            p = np.sqrt(x[k]**2 + y[k]**2)
+            mu = np.arctan(z[k] / p * ((1 - f) + ecc2 * r_e / r))
+            geod_lat = np.arctan((z[k] * (1 - f) + ecc2 * r_e * np.sin(mu)**3) /
+                                ((1 - f) * (p - ecc2 * r_e * np.cos(mu)**3)))
+            # Local Earth radius, as earth_model.local_earth_radius
+            gamma = r_e / np.sqrt(1 - ecc2 * np.sin(geod_lat)**2)
+            local_r = gamma * np.sqrt(np.cos(geod_lat)**2 + ((1 - ecc2) * np.sin(geod_lat))**2)
+            lat[k] = np.rad2deg(np.arctan(np.tan(geod_lat) * (1 - ecc2)))
+            lon[k] = np.rad2deg(np.arctan2(y[k], x[k]))
+            h[k] = r - local_r
+
+        return lat, lon, h
+
+    tdoa_G1_h = _nb_tdoa_G1_h
+    solve3 = _nb_solve3
+    r1_coefficients = _nb_r1_coefficients
+    quartic_roots = _nb_quartic_roots
+
+else:
+
+    tdoa_G1_h = _np_tdoa_G1_h
+    solve3 = _np_solve3
+    r1_coefficients = _np_r1_coefficients
+    quartic_roots = _np_quartic_roots
+
+
+def cartesian2geographic(x, y, z):
+    """
+    Convert cartesian coordinates to geographic coordinates, as
+    conversion.cartesian2geographic, using the Numba kernel if available.
+    """
+    if not HAS_NUMBA:
+        return _np_cartesian2geographic(x, y, z)
+
+    shape = np.shape(x)
+    lat, lon, h = _nb_cartesian2geographic(np.ravel(np.asarray(x, dtype = float)),
+                                          np.ravel(np.asarray(y, dtype = float)),
+                                          np.ravel(np.asarray(z, dtype = float)))
+
+    return lat.reshape(shape), lon.reshape(shape), h.reshape(shape)
+
+
+def tdoa_solve(sats, tdoa, r_emitter):
+    """
+    Solve for the emitter position of each of n fixes, each with three
+    satellites and known r_emitter.
+
+    Args:
+        sats: nx3x3 array of satellite positions [x,y,z] in meters.
+        tdoa: nx3 array of TDoA relative to the first satellite (first column zero).
+        r_emitter: Length n array of emitter distances from origin in meters.
+    Returns:
+        roots: nx4 array of the (complex) roots for r1 in meters.
+        solution: nx4x3 array of the emitter position [x,y,z] in meters
+            corresponding to each root.
+    """
+    sats = np.ascontiguousarray(sats, dtype = float)
+    tdoa = np.ascontiguousarray(tdoa, dtype = float)
+    r_emitter = np.ascontiguousarray(r_emitter, dtype = float)
+
+    G1, h = tdoa_G1_h(sats, tdoa, r_emitter)
+    G1_inv_h = solve3(G1, h)
+    coeffs = r1_coefficients(G1_inv_h, r_emitter)
+    roots = quartic_roots(coeffs)
+    # state = [1, r1, r1**2] for each root
+    state = np.stack([np.ones(roots.shape), roots, roots**2], axis = 1)
+    solution = np.transpose(np.matmul(G1_inv_h, state), (0, 2, 1))
+
+    return roots, solution
@@ -0,0 +1,229 @@
+"""
+Precomputed TDoA lookup table for coarse fixes over a region of interest.
+
+For a fixed constellation, the TDoA vector varies smoothly with the emitter
+position. The forward model is evaluated once over a grid of emitter
+positions, after which a coarse fix is found by interpolating between the
+nearest grid points in TDoA space. The coarse fix can be used directly (e.g.
+for triage), or to select between the solutions found by the Solver.
+"""
+
+import numpy as np
+from ..utils import constants, conversion, error_handling
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+class TDoAIndex(object):
+    def __init__(self,
+                sat_positions,
+                lat_range,
+                lon_range,
+                resolution,
+                h_emitter = 0.0,
+                ):
+        """
+        Args:
+            sat_positions: nx3 array of n satellite positions [x,y,z] in meters.
+                        TDoA are relative to the first satellite.
+            lat_range: (min, max) latitude of the region of interest in degrees.
+            lon_range: (west, east) longitude of the region of interest in
+                        degrees. The region may cross the antimeridian, e.g.
+                        (170, -170).
+            resolution: Grid spacing in degrees.
+            h_emitter: Assumed emitter height in meters above the Earth's surface.
+        """
+
+        sat_positions = np.array(sat_positions, dtype = float)
+        if sat_positions.ndim != 2 or sat_positions.shape[1] != 3 or len(sat_positions) < 3:
+            raise error_handling.InsufficientDataError(
+                "Lookup table requires [x,y,z] positions of at least 3 satellites.")
+
+        if resolution <= 0:
+            raise error_handling.UnknownCaseError("Grid resolution must be positive.")
+        if lat_range[1] < lat_range[0]:
+            raise error_handling.UnknownCaseError("lat_range must be given as (min, max).")
+        lon_west = lon_range[0]
+        lon_east = lon_range[1]
+        # Crossing the antimeridian
+        if lon_east < lon_west:
+            lon_east += 360.0
+        if lon_east - lon_west > 360.0:
+            raise error_handling.UnknownCaseError("lon_range spans more than 360 degrees.")
+
+        n_lat = int(round((lat_range[1] - lat_range[0]) / resolution)) + 1
+        n_lon = int(round((lon_east - lon_west) / resolution)) + 1
+        lat, lon = np.meshgrid(np.linspace(lat_range[0], lat_range[1], n_lat),
+                               np.linspace(lon_west, lon_east, n_lon),
+                               indexing = 'ij')
+        lon = (lon + 180.0) % 360.0 - 180.0
+        x, y, z = conversion.geographic2cartesian(lat = lat.ravel(), lon = lon.ravel(), h = h_emitter)
+
+        self.sat_positions = sat_positions
+        self.lat = lat.ravel()
+        self.lon = lon.ravel()
+        self.emitter_positions = np.stack([x, y, z], axis = 1)
+        self.h_emitter = h_emitter
+        self.resolution = resolution
+        self.ranges = self._ranges(np.arange(len(sat_positions)))
+        self._build_tree()
+
+
+    def _ranges(self, sats):
+        """
+        Distance (m) from each grid point to each of the given satellites.
+        """
+
+        diff = self.emitter_positions[:,np.newaxis,:] - self.sat_positions[np.newaxis,sats,:]
+
+        return np.sqrt(np.sum(diff**2, axis = 2))
+
+
+    def _build_tree(self):
+        """
+        Index the grid by range difference (TDoA * c) to each satellite other
+        than the first.
+        """
+
+        self._rdoa = self.ranges[:,1:] - self.ranges[:,:1]
+        self._tree = cKDTree(self._rdoa) if cKDTree is not None else None
+
+
+    def query(self, tdoa, k = 4):
+        """
+        Find the coarse emitter position for each TDoA vector by inverse
+        distance weighting of the k nearest grid points in TDoA space.
+
+        Args:
+            tdoa: nx(m-1) array of TDoA relative to the first satellite, or
+                        nxm if the first column is zero. A single TDoA vector
+                        may be given as a 1-D array.
+            k: Number of grid points to interpolate between.
+        Returns:
+            lat: Latitude in degrees.
+            lon: Longitude in degrees.
+            position: The emitter position [x,y,z] in meters.
+        """
+
+        tdoa = np.array(tdoa, dtype = float)
+        single = tdoa.ndim == 1
+        tdoa = np.atleast_2d(tdoa)
+        m = len(self.sat_positions)
+        if tdoa.shape[1] == m:
+            tdoa = tdoa[:,1:]
+        elif tdoa.shape[1] != m - 1:
+            raise error_handling.UnknownCaseError("Unknown TDoA format.")
+        rdoa = tdoa * constants.speed_of_light
+
+        k = min(k, len(self._rdoa))
+        if self._tree is not None:
+            dist, idx = self._tree.query(rdoa, k = k)
+            dist = dist.reshape(len(rdoa), k)
+            idx = idx.reshape(len(rdoa), k)
+        else:
+            # Brute force search, if scipy is unavailable.
+            dist = np.empty((len(rdoa), k))
+            idx = np.empty((len(rdoa), k), dtype = int)
+            for i, r in enumerate(rdoa):
+                dist_all = np.sqrt(np.sum((self._rdoa - r)**2, axis = 1))
+                idx[i] = np.argpartition(dist_all, k - 1)[:k]
+                dist[i] = dist_all[idx[i]]
+
+        weights = 1.0 / np.maximum(dist, 1.e-9)
+        weights /= np.sum(weights, axis = 1, keepdims = True)
+        lat = np.sum(weights * self.lat[idx], axis = 1)
+        # Average longitudes relative to the nearest point, so that neighbours
+        # either side of the antimeridian are not averaged to zero.
+        lon_ref = self.lon[idx[:,:1]]
+        dlon = (self.lon[idx] - lon_ref + 180.0) % 360.0 - 180.0
+        lon = (lon_ref[:,0] + np.sum(weights * dlon, axis = 1) + 180.0) % 360.0 - 180.0
+        position = np.sum(weights[:,:,np.newaxis] * self.emitter_positions[idx], axis = 1)
+
+        if single:
+            return lat[0], lon[0], position[0]
+
+        return lat, lon, position
+
+
+    def select(self, solution, tdoa):
+        """
+        Choose, from the candidate solutions found by the Solver, the one
+        closest to the coarse fix for the given TDoA.
+
+        Args:
+            solution: kx3 array of candidate emitter positions [x,y,z] in meters.
+            tdoa: TDoA vector for the fix, as for query.
+        Returns:
+            The candidate position [x,y,z] closest to the coarse fix.
+        """
+
+        solution = np.real(np.atleast_2d(solution))
+        if len(solution) == 0:
+            raise error_handling.InvalidSolutionError("No candidate solutions to select from.")
+        _, _, position = self.query(np.ravel(tdoa))
+
+        return solution[np.argmin(np.sum((solution - position)**2, axis = 1))]
+
+
+    def update(self, sat_positions, threshold):
+        """
+        Update the satellite geometry, recomputing the table only for the
+        satellites that have moved by more than threshold meters since the
+        table was last computed.
+
+        Returns:
+            True if the table was recomputed.
+        """
+
+        sat_positions = np.array(sat_positions, dtype = float)
+        if sat_positions.shape != self.sat_positions.shape:
+            raise error_handling.UnknownCaseError("Satellite geometry must keep the same number of satellites.")
+
+        drift = np.sqrt(np.sum((sat_positions - self.sat_positions)**2, axis = 1))
+        moved = np.flatnonzero(drift > threshold)
+        if len(moved) == 0:
+            return False
+
+        self.sat_positions[moved] = sat_positions[moved]
+        self.ranges[:,moved] = self._ranges(moved)
+        self._build_tree()
+
+        return True
+
+
+    def save(self, filepath):
+        """
+        Save the table to a .npz file.
+        """
+
+        np.savez(filepath,
+                sat_positions = self.sat_positions,
+                lat = self.lat,
+                lon = self.lon,
+                emitter_positions = self.emitter_positions,
+                ranges = self.ranges,
+                h_emitter = self.h_emitter,
+                resolution = self.resolution)
+
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Load a table saved with save.
+        """
+
+        index = cls.__new__(cls)
+        with np.load(filepath) as data:
+            index.sat_positions = data['sat_positions']
+            index.lat = data['lat']
+            index.lon = data['lon']
+            index.emitter_positions = data['emitter_positions']
+            index.ranges = data['ranges']
+            index.h_emitter = float(data['h_emitter'])
+            index.resolution = float(data['resolution'])
+        index._build_tree()
+
+        return index
@@ -3,21 +3,24 @@
 import os
 import pandas as pd
 import numpy as np
-from . import verify
-from ..utils import constants, io, error_handling, conversion
+from . import verify, kernels
+from ..utils import constants, io, error_handling, conversion, earth_model
 
 
 class Solver(object):
     def __init__(self,
                 system,
+                verbose = True,
                 ):
         """
         Args:
             system: Instance of the System class, containing information about the
                     system to be solved (receiver positions, TDoA, FDoA, etc.)
+            verbose: Print the solution/s once found.
         """
 
         self.system = system
+        self.verbose = verbose
 
     def solve(self):
         """
@@ -29,22 +32,14 @@ class Solver(object):
         sat_data = system.sat_data
         m = len(sat_data)
 
-        G1 = self.populate_G1()
-        h = self.populate_h()
-
         # TDoA only
         if (system.TDoA_data is not None and 
                 system.FDoA_data is None): 
             if m == 3: 
-                G1_inv = np.linalg.inv(G1)
-                G1_inv_h = np.matmul(G1_inv,h)
-                coeffs = self.get_r1_coefficients(G1_inv_h = G1_inv_h)
-                roots = np.roots(coeffs)
-                roots = roots[roots > 0]
-                state = np.transpose([[1, r1, r1**2] for r1 in roots])
-                solution = np.transpose(np.matmul(G1_inv_h, state))
+                roots, solution = self._TDoA_kernel_solve()
                 error = verify.solution_error(sat_data = sat_data, roots = roots, solution = solution, tdoa = system.TDoA_data)
-                self._print_solution(solution, roots, error)
+                if self.verbose:
+                    self._print_solution(solution, roots, error)
                 
                 return roots, solution
 
@@ -79,19 +74,11 @@ class Solver(object):
             system.FDoA_data = None
             self.system = system
         
-        G1 = self.populate_G1()
-        h = self.populate_h()
-
         if m == 3: 
-            G1_inv = np.linalg.inv(G1)
-            G1_inv_h = np.matmul(G1_inv,h)
-            coeffs = self.get_r1_coefficients(G1_inv_h = G1_inv_h)
-            roots = np.roots(coeffs)
-            roots = roots[roots > 0]
-            state = np.transpose([[1, r1, r1**2] for r1 in roots])
-            solution = np.transpose(np.matmul(G1_inv_h, state))
+            roots, solution = self._TDoA_kernel_solve()
             error = verify.solution_error(sat_data = sat_data, roots = roots, solution = solution, tdoa = system.TDoA_data)
-            self._print_solution(solution, roots, error) 
+            if self.verbose:
+                self._print_solution(solution, roots, error)
 
             return roots, solution
 
@@ -107,6 +94,112 @@ class Solver(object):
         self._reset_system_attrs()
 
 
+    def _TDoA_kernel_solve(self):
+        """
+        Solve the three satellite TDoA system with known r_emitter using the
+        kernels module (JIT-compiled if Numba is available). Equivalent to
+        solving with populate_G1, populate_h and get_r1_coefficients.
+
+        If the system has an earth_model, r_emitter is instead found by
+        iterating the altitude constraint against the model's surface.
+
+        Returns:
+            roots: The positive solutions for r1 in meters.
+            solution: The emitter position [x,y,z] in meters for each root.
+        """
+
+        system = self.system
+        sat_data = system.sat_data
+
+        if system.r_emitter is None and system.earth_model is None:
+            raise error_handling.UnknownCaseError("Solution for unknown r_emitter is not yet implemented")
+
+        sats = np.array(sat_data[['x','y','z']], dtype = float)
+        tdoa = np.array(sat_data.TDoA, dtype = float)
+        r_emitter = system.r_emitter if system.r_emitter is not None else earth_model.r_e
+        roots, solution = kernels.tdoa_solve(sats = sats[np.newaxis],
+                                            tdoa = tdoa[np.newaxis],
+                                            r_emitter = np.array([r_emitter]))
+        roots = np.real_if_close(roots[0])
+        positive = roots > 0
+        roots = roots[positive]
+        solution = np.real_if_close(solution[0][positive])
+
+        if system.earth_model is not None:
+            roots, solution = self._iterate_altitude(sats, tdoa, roots, solution)
+
+        return roots, solution
+
+
+    def _iterate_altitude(self, sats, tdoa, roots, solution, max_iter = 10, tol = 1.e-3):
+        """
+        Refine each candidate solution so that it lies on the surface of
+        system.earth_model (at the height of system.h_emitter above it). Each
+        step re-solves all candidates at once for the surface radius at their
+        current positions, keeping the root closest to the previous one.
+        Candidates whose root becomes complex or non-positive, or which do
+        not converge within max_iter steps, are dropped.
+
+        Args:
+            sats: 3x3 array of satellite positions [x,y,z] in meters.
+            tdoa: TDoA relative to the first satellite (first element zero).
+            roots: Initial solutions for r1 in meters.
+            solution: Initial emitter positions [x,y,z] in meters.
+            max_iter: Maximum number of iterations.
+            tol: Convergence tolerance on r_emitter in meters.
+        Raises:
+            InvalidSolutionError: If no candidate converges to a real,
+                positive root.
+        """
+
+        system = self.system
+
+        # Only real candidates are refined.
+        real = np.abs(np.imag(roots)) <= 1.e-9 * np.abs(roots)
+        roots = np.real(roots[real])
+        solution = np.real(solution[real])
+        n = len(roots)
+        if n == 0:
+            raise error_handling.InvalidSolutionError("No real solution to refine against the earth model.")
+
+        sats = np.repeat(sats[np.newaxis], n, axis = 0)
+        tdoa = np.repeat(tdoa[np.newaxis], n, axis = 0)
+        r_emitter = np.full(n, np.nan)
+        valid = np.ones(n, dtype = bool)
+        converged = np.zeros(n, dtype = bool)
+        for i in range(max_iter + 1):
+            active = np.flatnonzero(valid & ~converged)
+            if len(active) == 0:
+                break
+            lat, lon, _ = kernels.cartesian2geographic(x = solution[active,0],
+                                                       y = solution[active,1],
+                                                       z = solution[active,2])
+            r_new = system.earth_model.surface_radius(lat = lat, lon = lon, h = system.h_emitter)
+            done = np.abs(r_new - r_emitter[active]) < tol
+            converged[active[done]] = True
+            active = active[~done]
+            if len(active) == 0 or i == max_iter:
+                break
+            r_emitter[active] = r_new[~done]
+
+            new_roots, new_solution = kernels.tdoa_solve(sats = sats[active],
+                                                        tdoa = tdoa[active],
+                                                        r_emitter = r_emitter[active])
+            nearest = np.argmin(np.abs(new_roots - roots[active,np.newaxis]), axis = 1)
+            chosen = new_roots[np.arange(len(active)), nearest]
+            ok = (np.abs(chosen.imag) <= 1.e-9 * np.abs(chosen)) & (chosen.real > 0)
+            valid[active[~ok]] = False
+            roots[active[ok]] = chosen.real[ok]
+            solution[active[ok]] = np.real(new_solution[np.arange(len(active)), nearest][ok])
+
+        keep = valid & converged
+        if not keep.any():
+            raise error_handling.InvalidSolutionError(
+                "The altitude constraint did not converge to a real, positive solution.")
+
+        return roots[keep], solution[keep]
+
+
     def populate_G1(self):
         """
         """
@@ -14,6 +14,9 @@ class System(object):
                 r_emitter = None,
                 scale_distance = None,#1000.0,
                 scale_velocity = None,#1.0/3.6
+                earth_model = None,
+                h_emitter = 0.0,
+                verbose = True,
                 ):
         """
         Args:
@@ -33,6 +36,13 @@ class System(object):
                         provide a multiplying factor that will convert to meters.
             scale_velocity: If satellite velocity is not m/s,
                         provide a multiplying factor that will convert to m/s.
+            earth_model: Instance of earth_model.EarthModel. If provided, the
+                        emitter is constrained to lie at h_emitter above its
+                        surface, and r_emitter (if given) is only the
+                        starting point.
+            h_emitter: Emitter height in meters above the surface of
+                        earth_model.
+            verbose: Print notes about the system setup.
         """
 
         cols = ['r','latitude','longitude','x','y','z','TDoA']
@@ -65,7 +75,8 @@ class System(object):
 
         # Check whether FDoA data exists.
         if FDoA_data is None:
-            print('System does not contain FDoA information.')
+            if verbose:
+                print('System does not contain FDoA information.')
             self.FDoA_data = None
         elif FDoA_data is not None:
             # All FDoA including (\dot{d}_(1,1) = 0) are given
@@ -97,6 +108,8 @@ class System(object):
 
         self.sat_data = sat_data
         self.r_emitter = r_emitter
+        self.earth_model = earth_model
+        self.h_emitter = h_emitter
     
 
          
\ No newline at end of file
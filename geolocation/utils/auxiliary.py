@@ -25,7 +25,7 @@ def modify_sat_data_units(sat_data,
             sat_data.loc[:,'x'] = sat_data['x'] * scale_distance
             sat_data.loc[:,'y'] = sat_data['y'] * scale_distance
             sat_data.loc[:,'z'] = sat_data['z'] * scale_distance
-        lat, lon, h = conversion.cartesian2geographic(x, y, z)
+        lat, lon, h = conversion.cartesian2geographic(x = sat_data.x, y = sat_data.y, z = sat_data.z)
         sat_data.loc[:,'latitude'] = lat
         sat_data.loc[:,'longitude'] = lon
         sat_data.loc[:,'h'] = h
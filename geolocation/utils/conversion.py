@@ -78,7 +78,7 @@ def cartesian2geographic(x, y, z):
         raise error_handling.InvalidSolutionError("Unable to convert coordinates.")
     f = float(f)
     mu = np.arctan(z / p * ((1 - f) + ecc**2 * r_e / r) )
-    lon = np.arctan(y / x)
+    lon = np.arctan2(y, x)
     lat = np.arctan((z * (1-f) + ecc**2*r_e*np.sin(mu)**3) / ((1 - f) * (p - ecc**2*r_e*np.cos(mu)**3))) 
     
     lat = geodetic2geographic(lat)
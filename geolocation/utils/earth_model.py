@@ -1,7 +1,10 @@
-"""Utils for Earth model. Assumed to be an oblate spheroid."""
+"""Utils for Earth model. Assumed to be an oblate spheroid (WGS84), optionally
+with the surface height above it given by gridded terrain/geoid data."""
 
+import collections
+import os
 import numpy as np
-from . import conversion
+from . import conversion, error_handling
 
 # Equatorial radius
 r_e = 6378137.0
@@ -11,7 +14,7 @@ ecc = 0.0818191908426214957
 def local_earth_radius(lat, lon):
     """
     The local Earth radius for given latitude and longitude.
-    
+
     Args:
         lat: Latitude in degrees (neg. south) [-90,90]
         lon: Longitude in degrees (neg. west) [-180,180]
@@ -26,3 +29,148 @@ def local_earth_radius(lat, lon):
     return r
 
 
+class EarthModel(object):
+    """
+    The WGS84 ellipsoid, with no surface height. Subclasses provide the height
+    of the surface above the ellipsoid through height().
+    """
+
+    def height(self, lat, lon):
+        """
+        Height of the surface above the ellipsoid in meters.
+
+        Args:
+            lat: Latitude in degrees (neg. south) [-90,90]
+            lon: Longitude in degrees (neg. west) [-180,180]
+        """
+
+        return np.zeros(np.shape(lat))
+
+    def surface_radius(self, lat, lon, h = 0.0):
+        """
+        Distance from the origin in meters of a point at height h above the
+        surface.
+
+        Args:
+            lat: Latitude in degrees (neg. south) [-90,90]
+            lon: Longitude in degrees (neg. west) [-180,180]
+            h: Height in meters above the surface.
+        """
+
+        x, y, z = conversion.geographic2cartesian(lat = lat, lon = lon, h = self.height(lat, lon) + h)
+
+        return np.sqrt(x**2 + y**2 + z**2)
+
+
+WGS84 = EarthModel()
+
+
+class GriddedHeightModel(EarthModel):
+    def __init__(self,
+                directory,
+                geoid = None,
+                cache_size = 16,
+                fill_value = 0.0,
+                ):
+        """
+        Surface height from 1x1 degree tiles of gridded heights, stored as .npy
+        files and read through memory mapping. Tiles are named by their
+        south-west corner (e.g. N45E075.npy, S01W050.npy), with row 0 at the
+        northern edge and column 0 at the western edge, both edges inclusive.
+
+        Args:
+            directory: Directory containing the tiles.
+            geoid: Optional EarthModel giving the geoid height above the
+                        ellipsoid, if the tiles are heights above the geoid.
+            cache_size: Maximum number of tiles held open at once.
+            fill_value: Height in meters where no tile is available.
+        """
+
+        if not os.path.isdir(directory):
+            raise error_handling.InsufficientDataError(f"Height model directory {directory} does not exist.")
+
+        self.directory = directory
+        self.geoid = geoid
+        self.cache_size = cache_size
+        self.fill_value = fill_value
+        self._cache = collections.OrderedDict()
+
+    def __getstate__(self):
+        # Do not copy the memory mapped tiles when pickling.
+        state = self.__dict__.copy()
+        state['_cache'] = collections.OrderedDict()
+        return state
+
+    def tile_name(self, lat0, lon0):
+        """
+        File name of the tile with south-west corner (lat0, lon0).
+        """
+
+        ns = 'N' if lat0 >= 0 else 'S'
+        ew = 'E' if lon0 >= 0 else 'W'
+
+        return f"{ns}{abs(int(lat0)):02d}{ew}{abs(int(lon0)):03d}.npy"
+
+    def _tile(self, lat0, lon0):
+        """
+        The (memory mapped) tile with south-west corner (lat0, lon0), or None
+        if it does not exist.
+        """
+
+        key = (lat0, lon0)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        filepath = os.path.join(self.directory, self.tile_name(lat0, lon0))
+        tile = np.load(filepath, mmap_mode = 'r') if os.path.exists(filepath) else None
+        self._cache[key] = tile
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last = False)
+
+        return tile
+
+    def height(self, lat, lon):
+        """
+        Height of the surface above the ellipsoid in meters, by bilinear
+        interpolation of the tiles.
+
+        Args:
+            lat: Latitude in degrees (neg. south) [-90,90]. Converted to
+                        geodetic latitude to index the tiles.
+            lon: Longitude in degrees (neg. west) [-180,180]
+        """
+
+        shape = np.shape(lat)
+        geo_lat = np.ravel(np.asarray(lat, dtype = float))
+        lat = np.rad2deg(conversion.geographic2geodetic(np.deg2rad(geo_lat)))
+        lon = np.ravel(np.asarray(lon, dtype = float))
+        lon = (lon + 180.0) % 360.0 - 180.0
+        h = np.full(len(lat), self.fill_value, dtype = float)
+
+        lat0 = np.floor(lat)
+        lon0 = np.floor(lon)
+        tiles, inverse = np.unique(np.stack([lat0, lon0], axis = 1), axis = 0, return_inverse = True)
+        inverse = np.ravel(inverse)
+        for i, (t_lat0, t_lon0) in enumerate(tiles):
+            tile = self._tile(t_lat0, t_lon0)
+            if tile is None:
+                continue
+            members = inverse == i
+            n_rows, n_cols = tile.shape
+            # Fractional row/column positions in the tile
+            row = (t_lat0 + 1 - lat[members]) * (n_rows - 1)
+            col = (lon[members] - t_lon0) * (n_cols - 1)
+            r0 = np.clip(np.floor(row).astype(int), 0, n_rows - 2)
+            c0 = np.clip(np.floor(col).astype(int), 0, n_cols - 2)
+            dr = row - r0
+            dc = col - c0
+            h[members] = (tile[r0, c0] * (1 - dr) * (1 - dc) +
+                          tile[r0 + 1, c0] * dr * (1 - dc) +
+                          tile[r0, c0 + 1] * (1 - dr) * dc +
+                          tile[r0 + 1, c0 + 1] * dr * dc)
+
+        if self.geoid is not None:
+            h = h + np.ravel(self.geoid.height(lat = geo_lat, lon = lon))
+
+        return h.reshape(shape)
@@ -5,3 +5,12 @@ def load_csv_generic(filepath):
     df = pd.read_csv(filepath, comment = '#')
 
     return df
+
+def iter_csv_chunks(filepath, chunksize):
+    """
+    Iterate over a csv file in chunks of (at most) chunksize rows, so that large
+    files need not be held in memory.
+    """
+
+    for df in pd.read_csv(filepath, comment = '#', chunksize = chunksize):
+        yield df
@@ -0,0 +1,43 @@
+"""Shared test setup, using the satellites of Section VI of Ho & Chan (1997)."""
+
+import numpy as np
+import pandas as pd
+from geolocation.solver import system, verify
+from geolocation.utils import earth_model
+
+sat_r = [42164, 42164, 42164] #km
+sat_lat = [2.0, 0.0, 0.0]
+sat_lon = [-50.0, -47.0, -53.0]
+
+def sat_data(sat_lon = sat_lon):
+    sys = system.System(satellite_positions = np.array([sat_r,sat_lat,sat_lon]).T,
+                        is_geographic_coords = True,
+                        TDoA_data = [0.0, 0.0, 0.0],
+                        scale_distance = 1000.0,
+                        verbose = False,
+                        )
+    return sys.sat_data
+
+def generate_tdoa(lat_emitter, lon_emitter, sat_lon = sat_lon):
+    """
+    Noise free TDoA for an emitter on the ellipsoid, and its r_emitter.
+    """
+    r_emitter = earth_model.local_earth_radius(lat = lat_emitter, lon = lon_emitter)
+    tdoa = verify.generate_TDOA(sat_data = sat_data(sat_lon),
+                r_emitter = r_emitter,
+                lat_emitter = lat_emitter,
+                lon_emitter = lon_emitter,
+                tdoa_var = 0.0)
+
+    return tdoa, r_emitter
+
+def write_inputs(tmp_path, measurements, sat_lon = sat_lon):
+    """
+    Write a DataFrame of measurements and the (static) ephemeris as csv.
+    """
+    measurements_path = tmp_path / 'measurements.csv'
+    measurements.to_csv(measurements_path, index = False)
+    ephemeris_path = tmp_path / 'satellites.csv'
+    pd.DataFrame({'r': sat_r, 'latitude': sat_lat, 'longitude': sat_lon}).to_csv(ephemeris_path, index = False)
+
+    return str(measurements_path), str(ephemeris_path)
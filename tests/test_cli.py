@@ -0,0 +1,71 @@
+"""Test the command line batch solver."""
+
+import numpy as np
+import pandas as pd
+from geolocation import cli
+from .helpers import generate_tdoa, write_inputs
+
+lat_emitter = 45.35
+lon_emitter = 75.9
+
+def _write_inputs(tmp_path, n_fixes, lat = lat_emitter, lon = lon_emitter, **kwargs):
+    tdoa, r_emitter = generate_tdoa(lat, lon, **kwargs)
+    measurements = pd.DataFrame({'fix_id': np.arange(n_fixes),
+                                 'TDoA_1': tdoa[1],
+                                 'TDoA_2': tdoa[2],
+                                 'r_emitter': r_emitter})
+
+    return write_inputs(tmp_path, measurements, **kwargs)
+
+def test_cli_tdoa(tmp_path):
+    measurements, ephemeris = _write_inputs(tmp_path, n_fixes = 5)
+    output = str(tmp_path / 'solutions.csv')
+    status = cli.main([measurements, ephemeris, '--scale-distance', '1000.0',
+                       '--batch-size', '2', '--chunk-size', '3', '-o', output])
+    assert status == 0
+
+    df = pd.read_csv(output)
+    assert list(df.columns) == cli.OUTPUT_COLUMNS
+    assert sorted(df.fix_id.unique()) == list(range(5))
+    for _, fix in df.groupby('fix_id'):
+        assert np.min(np.abs(fix.latitude - lat_emitter) + np.abs(fix.longitude - lon_emitter)) < 1.e-6
+
+def test_cli_failed_fix(tmp_path, capsys):
+    # A fix without r_emitter fails, but does not stop the run
+    measurements, ephemeris = _write_inputs(tmp_path, n_fixes = 3)
+    df = pd.read_csv(measurements)
+    df.loc[1, 'r_emitter'] = np.nan
+    df.to_csv(measurements, index = False)
+    output = str(tmp_path / 'solutions.csv')
+    assert cli.main([measurements, ephemeris, '--scale-distance', '1000.0', '-o', output]) == 0
+
+    assert sorted(pd.read_csv(output).fix_id.unique()) == [0, 2]
+    assert "Fixes: 3 (1 failed)" in capsys.readouterr().err
+
+def test_cli_west_of_90(tmp_path):
+    # Longitudes beyond 90 degrees are not folded onto the other hemisphere
+    measurements, ephemeris = _write_inputs(tmp_path, n_fixes = 1, lat = -20.0, lon = -120.0,
+                                            sat_lon = [-120.0, -117.0, -123.0])
+    output = str(tmp_path / 'solutions.csv')
+    assert cli.main([measurements, ephemeris, '--scale-distance', '1000.0', '-o', output]) == 0
+
+    df = pd.read_csv(output)
+    assert np.min(np.abs(df.latitude + 20.0) + np.abs(df.longitude + 120.0)) < 1.e-6
+
+def test_cli_missing_ephemeris(tmp_path, capsys):
+    # A fix with no per-fix ephemeris fails, but does not stop the run
+    measurements, ephemeris = _write_inputs(tmp_path, n_fixes = 3)
+    eph = pd.read_csv(ephemeris)
+    eph = pd.concat([eph.assign(fix_id = fix_id) for fix_id in [0, 2]], ignore_index = True)
+    eph.to_csv(ephemeris, index = False)
+    output = str(tmp_path / 'solutions.csv')
+    assert cli.main([measurements, ephemeris, '--scale-distance', '1000.0',
+                     '--batch-size', '1', '-o', output]) == 0
+
+    assert sorted(pd.read_csv(output).fix_id.unique()) == [0, 2]
+    assert "Fixes: 3 (1 failed)" in capsys.readouterr().err
+
+def test_cli_unimplemented_mode(tmp_path):
+    measurements, ephemeris = _write_inputs(tmp_path, n_fixes = 1)
+    for mode in ['tfdoa', 'wls', 'robust']:
+        assert cli.main([measurements, ephemeris, '--mode', mode]) == 1
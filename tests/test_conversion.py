@@ -1,5 +1,6 @@
 """Test conversion functions."""
 
+import numpy as np
 from geolocation.utils import conversion, earth_model
 
 x_test = earth_model.r_e
@@ -21,3 +22,12 @@ def test_geographic2cartesian():
     assert x == x_test
     assert y == y_test
     assert z == z_test
+
+def test_cartesian2geographic_quadrants():
+    lat = [30.0, -30.0, 30.0, -30.0]
+    lon = [45.0, 135.0, -135.0, -45.0]
+    x, y, z = conversion.geographic2cartesian(lat = lat, lon = lon, h = 1000.0)
+    lat_calc, lon_calc, h_calc = conversion.cartesian2geographic(x = x, y = y, z = z)
+    assert np.allclose(lat_calc, lat)
+    assert np.allclose(lon_calc, lon)
+    assert np.allclose(h_calc, 1000.0, atol = 1.e-6)
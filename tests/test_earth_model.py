@@ -0,0 +1,113 @@
+"""Test the earth models and the solution constrained to the terrain."""
+
+import numpy as np
+import pytest
+from geolocation.solver import solver, system
+from geolocation.utils import constants, conversion, earth_model, error_handling
+
+lat_emitter = 45.35
+lon_emitter = 75.9
+
+sat_positions = np.stack(conversion.geographic2cartesian(lat = [2.0, 0.0, 0.0],
+                                                        lon = [-50.0, -47.0, -53.0],
+                                                        h = 35786.0e3), axis = 1)
+
+def _write_tiles(directory, height, lat_tiles = range(44, 47), lon_tiles = range(74, 78)):
+    """
+    Tiles around the emitter with height a function of geodetic (lat, lon).
+    """
+    directory.mkdir()
+    for lat0 in lat_tiles:
+        for lon0 in lon_tiles:
+            lat, lon = np.meshgrid(np.linspace(lat0 + 1, lat0, 121),
+                                   np.linspace(lon0, lon0 + 1, 121),
+                                   indexing = 'ij')
+            np.save(directory / f"N{lat0:02d}E{lon0:03d}.npy", height(lat, lon))
+
+    return str(directory)
+
+def _geodetic(lat):
+    return np.rad2deg(conversion.geographic2geodetic(np.deg2rad(lat)))
+
+def test_gridded_height(tmp_path):
+    terrain = _write_tiles(tmp_path / 'terrain', lambda lat, lon: 100.0 * lat + 10.0 * lon)
+    geoid = _write_tiles(tmp_path / 'geoid', lambda lat, lon: np.full(lat.shape, 30.0))
+    model = earth_model.GriddedHeightModel(terrain,
+                                            geoid = earth_model.GriddedHeightModel(geoid),
+                                            cache_size = 2)
+
+    lat = np.array([lat_emitter, 44.5, 46.7])
+    lon = np.array([lon_emitter, 74.2, 77.5])
+    # Bilinear interpolation is exact for a linear height
+    assert np.allclose(model.height(lat, lon), 100.0 * _geodetic(lat) + 10.0 * lon + 30.0)
+    assert len(model._cache) <= 2
+
+    # Outside of the tiles
+    assert model.height(0.0, 0.0) == 0.0 + 0.0
+
+def test_WGS84():
+    assert np.isclose(earth_model.WGS84.surface_radius(lat = lat_emitter, lon = lon_emitter),
+                      earth_model.local_earth_radius(lat = lat_emitter, lon = lon_emitter))
+
+def test_terrain_solve(tmp_path):
+    terrain = _write_tiles(tmp_path / 'terrain', lambda lat, lon: 2000.0 + 50.0 * (lat - 45.0))
+    model = earth_model.GriddedHeightModel(terrain)
+
+    h_terrain = model.height(lat_emitter, lon_emitter)
+    emitter = np.array(conversion.geographic2cartesian(lat = lat_emitter, lon = lon_emitter, h = h_terrain))
+    d = np.sqrt(np.sum((sat_positions - emitter)**2, axis = 1))
+    tdoa = (d - d[0]) / constants.speed_of_light
+
+    sys = system.System(satellite_positions = sat_positions,
+                        is_geographic_coords = False,
+                        TDoA_data = tdoa,
+                        earth_model = model,
+                        verbose = False,
+                        )
+    roots, solution = solver.Solver(sys, verbose = False).TDoA_solve()
+    assert np.min(np.sqrt(np.sum((solution - emitter)**2, axis = 1))) < 1.e-2
+
+def test_terrain_solve_east_of_90(tmp_path):
+    # Longitudes beyond 90 degrees must not be folded onto the other side of
+    # the globe when reading the terrain.
+    lat, lon = 30.0, 120.0
+    terrain = _write_tiles(tmp_path / 'terrain', lambda lat, lon: np.full(lat.shape, 2000.0),
+                           lat_tiles = range(28, 32), lon_tiles = range(118, 122))
+    model = earth_model.GriddedHeightModel(terrain)
+    sats = np.stack(conversion.geographic2cartesian(lat = [2.0, 0.0, 0.0],
+                                                    lon = [120.0, 117.0, 123.0],
+                                                    h = 35786.0e3), axis = 1)
+
+    emitter = np.array(conversion.geographic2cartesian(lat = lat, lon = lon, h = model.height(lat, lon)))
+    d = np.sqrt(np.sum((sats - emitter)**2, axis = 1))
+    sys = system.System(satellite_positions = sats,
+                        is_geographic_coords = False,
+                        TDoA_data = (d - d[0]) / constants.speed_of_light,
+                        earth_model = model,
+                        verbose = False,
+                        )
+    roots, solution = solver.Solver(sys, verbose = False).TDoA_solve()
+    assert np.min(np.sqrt(np.sum((solution - emitter)**2, axis = 1))) < 1.e-2
+
+class _OscillatingModel(earth_model.EarthModel):
+    """
+    Surface height that alternates between calls, so never converges.
+    """
+    def __init__(self):
+        self.n_calls = 0
+
+    def height(self, lat, lon):
+        self.n_calls += 1
+        return np.full(np.shape(lat), 5000.0 * (self.n_calls % 2))
+
+def test_terrain_solve_not_converged():
+    emitter = np.array(conversion.geographic2cartesian(lat = lat_emitter, lon = lon_emitter))
+    d = np.sqrt(np.sum((sat_positions - emitter)**2, axis = 1))
+    sys = system.System(satellite_positions = sat_positions,
+                        is_geographic_coords = False,
+                        TDoA_data = (d - d[0]) / constants.speed_of_light,
+                        earth_model = _OscillatingModel(),
+                        verbose = False,
+                        )
+    with pytest.raises(error_handling.InvalidSolutionError):
+        solver.Solver(sys, verbose = False).TDoA_solve()
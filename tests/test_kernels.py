@@ -0,0 +1,105 @@
+"""Test the solver kernels, and parity between the NumPy and Numba versions."""
+
+import numpy as np
+import pytest
+from geolocation.solver import kernels, solver, system
+from geolocation.utils import constants, conversion, earth_model
+
+requires_numba = pytest.mark.skipif(not kernels.HAS_NUMBA, reason = "Numba is not installed")
+
+def _random_fixes(n, seed = 0):
+    rng = np.random.default_rng(seed)
+    sat_lat = rng.uniform(-5, 5, size = (n, 3))
+    sat_lon = rng.uniform(-60, -40, size = (n, 3))
+    sats = np.stack(conversion.geographic2cartesian(lat = sat_lat, lon = sat_lon, h = 35786.0e3), axis = 2)
+    lat_emitter = rng.uniform(-60, 60, size = n)
+    lon_emitter = rng.uniform(-80, -20, size = n)
+    r_emitter = earth_model.local_earth_radius(lat = lat_emitter, lon = lon_emitter)
+    emitter = np.stack(conversion.geographic2cartesian(lat = lat_emitter, lon = lon_emitter), axis = 1)
+    d = np.sqrt(np.sum((sats - emitter[:,np.newaxis])**2, axis = 2))
+    tdoa = (d - d[:,:1]) / constants.speed_of_light
+
+    return sats, tdoa, r_emitter
+
+def _sort_roots(roots):
+    return np.sort_complex(np.round(roots, 3))
+
+def _match_roots(roots, other):
+    """
+    Reorder other so that each of its roots is paired with the nearest root
+    in roots.
+    """
+    other = list(other)
+    matched = []
+    for r in roots:
+        i = np.argmin(np.abs(np.array(other) - r))
+        matched.append(other.pop(i))
+
+    return np.array(matched)
+
+def test_numpy_kernels_match_solver():
+    sats, tdoa, r_emitter = _random_fixes(1)
+    sys = system.System(satellite_positions = sats[0],
+                        is_geographic_coords = False,
+                        TDoA_data = tdoa[0],
+                        r_emitter = r_emitter[0],
+                        verbose = False,
+                        )
+    s = solver.Solver(sys, verbose = False)
+
+    G1, h = kernels._np_tdoa_G1_h(sats, tdoa, r_emitter)
+    assert np.allclose(G1[0], s.populate_G1())
+    assert np.allclose(h[0], s.populate_h())
+
+    G1_inv_h = kernels._np_solve3(G1, h)
+    assert np.allclose(G1_inv_h[0], np.matmul(np.linalg.inv(G1[0]), h[0]))
+
+    coeffs = kernels._np_r1_coefficients(G1_inv_h, r_emitter)
+    assert np.allclose(coeffs[0], s.get_r1_coefficients(G1_inv_h = G1_inv_h[0]))
+    assert np.allclose(_sort_roots(kernels._np_quartic_roots(coeffs)[0]),
+                       _sort_roots(np.roots(coeffs[0])))
+
+@requires_numba
+def test_kernel_parity():
+    sats, tdoa, r_emitter = _random_fixes(50)
+
+    G1_np, h_np = kernels._np_tdoa_G1_h(sats, tdoa, r_emitter)
+    G1_nb, h_nb = kernels._nb_tdoa_G1_h(sats, tdoa, r_emitter)
+    assert np.allclose(G1_np, G1_nb)
+    assert np.allclose(h_np, h_nb)
+
+    G1_inv_h_np = kernels._np_solve3(G1_np, h_np)
+    G1_inv_h_nb = kernels._nb_solve3(G1_np, h_np)
+    assert np.allclose(G1_inv_h_np, G1_inv_h_nb)
+
+    coeffs_np = kernels._np_r1_coefficients(G1_inv_h_np, r_emitter)
+    coeffs_nb = kernels._nb_r1_coefficients(G1_inv_h_np, r_emitter)
+    assert np.allclose(coeffs_np, coeffs_nb)
+
+    roots_np = kernels._np_quartic_roots(coeffs_np)
+    roots_nb = kernels._nb_quartic_roots(coeffs_np)
+    for r_np, r_nb in zip(roots_np, roots_nb):
+        assert np.allclose(r_np, _match_roots(r_np, r_nb), rtol = 1.e-7, atol = 1.e-3)
+
+@requires_numba
+def test_cartesian2geographic_parity():
+    # Points in all four quadrants of longitude
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(-80, 80, size = 40)
+    lon = rng.uniform(-180, 180, size = 40)
+    x, y, z = conversion.geographic2cartesian(lat = lat, lon = lon, h = 1000.0)
+    lat_np, lon_np, h_np = kernels._np_cartesian2geographic(x, y, z)
+    lat_nb, lon_nb, h_nb = kernels.cartesian2geographic(x, y, z)
+    assert np.allclose(lat_np, lat_nb)
+    assert np.allclose(lon_np, lon_nb)
+    assert np.allclose(lon_nb, lon)
+    assert np.allclose(h_np, h_nb, atol = 1.e-6)
+
+def test_tdoa_solve():
+    sats, tdoa, r_emitter = _random_fixes(10)
+    roots, solution = kernels.tdoa_solve(sats, tdoa, r_emitter)
+    d = np.sqrt(np.sum((sats[:,np.newaxis,:,:] - solution[:,:,np.newaxis,:])**2, axis = 3))
+    # Each fix has a solution reproducing the TDoA
+    tdoa_calc = (d - d[:,:,:1]) / constants.speed_of_light
+    residual = np.max(np.abs(tdoa_calc - tdoa[:,np.newaxis,:]), axis = 2)
+    assert (np.min(residual, axis = 1) < 1.e-12).all()
@@ -0,0 +1,80 @@
+"""Test the TDoA lookup table."""
+
+import numpy as np
+import pytest
+from geolocation.solver import lookup
+from geolocation.utils import constants, conversion, error_handling
+
+lat_emitter = 45.35
+lon_emitter = 75.9
+
+sat_positions = np.stack(conversion.geographic2cartesian(lat = [2.0, 0.0, 0.0],
+                                                        lon = [-50.0, -47.0, -53.0],
+                                                        h = 35786.0e3), axis = 1)
+
+def _tdoa(sat_positions, lat, lon):
+    emitter = np.array(conversion.geographic2cartesian(lat = lat, lon = lon))
+    d = np.sqrt(np.sum((sat_positions - emitter)**2, axis = 1))
+    return (d - d[0]) / constants.speed_of_light
+
+def _index():
+    return lookup.TDoAIndex(sat_positions = sat_positions,
+                            lat_range = (40.0, 50.0),
+                            lon_range = (70.0, 80.0),
+                            resolution = 0.25)
+
+def test_query():
+    index = _index()
+    lat, lon, position = index.query(_tdoa(sat_positions, lat_emitter, lon_emitter))
+    assert abs(lat - lat_emitter) < index.resolution
+    assert abs(lon - lon_emitter) < index.resolution
+
+    # Batched query, TDoA given relative to the first satellite only
+    tdoa = np.array([_tdoa(sat_positions, lat_emitter, lon_emitter)[1:]] * 2)
+    lat, lon, position = index.query(tdoa)
+    assert lat.shape == (2,) and position.shape == (2, 3)
+
+def test_select():
+    index = _index()
+    emitter = np.array(conversion.geographic2cartesian(lat = lat_emitter, lon = lon_emitter))
+    solution = np.array([-emitter, emitter])
+    selected = index.select(solution, _tdoa(sat_positions, lat_emitter, lon_emitter))
+    assert np.allclose(selected, emitter)
+
+def test_save_load(tmp_path):
+    index = _index()
+    filepath = str(tmp_path / 'index.npz')
+    index.save(filepath)
+    loaded = lookup.TDoAIndex.load(filepath)
+    tdoa = _tdoa(sat_positions, lat_emitter, lon_emitter)
+    assert np.allclose(index.query(tdoa)[2], loaded.query(tdoa)[2])
+
+def test_update():
+    index = _index()
+    assert not index.update(sat_positions + 1.0, threshold = 10.0)
+
+    moved = sat_positions.copy()
+    moved[1] += 50.e3
+    assert index.update(moved, threshold = 10.0)
+    rebuilt = lookup.TDoAIndex(sat_positions = moved,
+                               lat_range = (40.0, 50.0),
+                               lon_range = (70.0, 80.0),
+                               resolution = 0.25)
+    assert np.allclose(index.ranges, rebuilt.ranges)
+
+def test_antimeridian():
+    sats = np.stack(conversion.geographic2cartesian(lat = [2.0, 0.0, 0.0],
+                                                   lon = [180.0, 175.0, -175.0],
+                                                   h = 35786.0e3), axis = 1)
+    index = lookup.TDoAIndex(sat_positions = sats,
+                             lat_range = (0.0, 20.0),
+                             lon_range = (170.0, -170.0),
+                             resolution = 0.25)
+    for lon_true in [179.9, -179.9]:
+        lat, lon, _ = index.query(_tdoa(sats, 10.0, lon_true))
+        assert abs(lat - 10.0) < index.resolution
+        assert abs((lon - lon_true + 180.0) % 360.0 - 180.0) < index.resolution
+
+    with pytest.raises(error_handling.UnknownCaseError):
+        lookup.TDoAIndex(sat_positions = sats, lat_range = (20.0, 0.0),
+                         lon_range = (170.0, -170.0), resolution = 0.25)
@@ -0,0 +1,131 @@
+"""Test the memory-bounded reprocessing job."""
+
+import numpy as np
+import pandas as pd
+import pytest
+from geolocation import reprocess
+from geolocation.solver import lookup
+from geolocation.utils import conversion, error_handling
+from . import helpers
+
+# The memory budget is deliberately tiny, to force several chunks.
+pytestmark = pytest.mark.filterwarnings("ignore:Resident set size grew")
+
+emitters = {1: (45.35, 75.9), 2: (30.0, 60.0)}
+
+def _measurements(n_fixes, sat_lon = helpers.sat_lon):
+    rows = []
+    for i in range(n_fixes):
+        emitter_id = 1 + i % 2
+        tdoa, r_emitter = helpers.generate_tdoa(*emitters[emitter_id], sat_lon = sat_lon)
+        rows.append({'fix_id': i, 'time': 10.0 * i, 'emitter_id': emitter_id,
+                     'TDoA_1': tdoa[1], 'TDoA_2': tdoa[2], 'r_emitter': r_emitter})
+
+    return pd.DataFrame(rows)
+
+def _index():
+    return lookup.TDoAIndex(sat_positions = np.array(helpers.sat_data()[['x','y','z']]),
+                            lat_range = (25.0, 50.0),
+                            lon_range = (55.0, 80.0),
+                            resolution = 0.5)
+
+def _job(measurements, ephemeris, output_dir, **kwargs):
+    # Budget small enough to force several chunks
+    return reprocess.ReprocessingJob(measurements = measurements,
+                                    ephemeris = ephemeris,
+                                    output_dir = output_dir,
+                                    time_window = 40.0,
+                                    memory_budget = 5 * reprocess.BYTES_PER_FIX,
+                                    scale_distance = 1000.0,
+                                    **kwargs)
+
+def _assert_mean_positions(aggregates):
+    means = aggregates.mean_positions()
+    assert sorted(means) == [1, 2]
+    for emitter_id, position in means.items():
+        lat, lon, _ = conversion.cartesian2geographic(x = position[0], y = position[1], z = position[2])
+        assert np.allclose([lat, lon], emitters[emitter_id], atol = 1.e-6)
+
+def test_reprocess(tmp_path):
+    measurements, ephemeris = helpers.write_inputs(tmp_path, _measurements(12))
+    output_dir = str(tmp_path / 'store')
+    job = _job(measurements, ephemeris, output_dir, index = _index())
+    summary = job.run()
+    assert summary['fixes'] == 12
+    assert summary['windows'] == [0, 1, 2]
+    assert summary['peak_rss'] > 0
+
+    segments = list(reprocess.ResultStore.iter_segments(output_dir))
+    assert len(segments) > 3
+    assert sum(len(s) for s in segments) == summary['solutions']
+    window = np.concatenate(list(reprocess.ResultStore.iter_segments(output_dir, window = 1)))
+    assert (window[:,reprocess.STORE_COLUMNS.index('time')] // 40.0 == 1).all()
+
+    assert job.aggregates.counts == {1: 6, 2: 6}
+    assert job.aggregates.residual_hist.sum() == 12
+    _assert_mean_positions(job.aggregates)
+
+def test_reprocess_ambiguous(tmp_path):
+    # Without an index the two candidates of each fix cannot be told apart
+    measurements, ephemeris = helpers.write_inputs(tmp_path, _measurements(6))
+    job = _job(measurements, ephemeris, str(tmp_path / 'store'))
+    job.run()
+    assert job.aggregates.counts == {1: 3, 2: 3}
+    assert job.aggregates.n_ambiguous == {1: 3, 2: 3}
+    assert job.aggregates.mean_positions() == {}
+
+def test_reprocess_per_fix_ephemeris(tmp_path):
+    measurements, _ = helpers.write_inputs(tmp_path, _measurements(12))
+    ephemeris = tmp_path / 'per_fix_satellites.csv'
+    # Includes a fix (100) with no measurements, which is skipped
+    pd.DataFrame({'fix_id': np.repeat(list(range(6)) + [100] + list(range(6, 12)), 3),
+                  'r': helpers.sat_r * 13,
+                  'latitude': helpers.sat_lat * 13,
+                  'longitude': helpers.sat_lon * 13}).to_csv(ephemeris, index = False)
+    job = _job(measurements, str(ephemeris), str(tmp_path / 'store'), index = _index())
+    summary = job.run()
+    assert summary['fixes'] == 12 and summary['failed'] == 0
+    _assert_mean_positions(job.aggregates)
+
+def test_reprocess_index_update(tmp_path):
+    # The second half of the fixes are seen by a different constellation to
+    # the one the index was computed for.
+    sat_lon = [-20.0, -17.0, -23.0]
+    df = pd.concat([_measurements(6), _measurements(12, sat_lon = sat_lon).iloc[6:]], ignore_index = True)
+    measurements, _ = helpers.write_inputs(tmp_path, df)
+    ephemeris = tmp_path / 'per_fix_satellites.csv'
+    pd.DataFrame({'fix_id': np.repeat(np.arange(12), 3),
+                  'r': helpers.sat_r * 12,
+                  'latitude': helpers.sat_lat * 12,
+                  'longitude': helpers.sat_lon * 6 + sat_lon * 6}).to_csv(ephemeris, index = False)
+    index = _index()
+    job = _job(measurements, str(ephemeris), str(tmp_path / 'store'), index = index)
+    job.run()
+    _assert_mean_positions(job.aggregates)
+    assert np.allclose(index.sat_positions, helpers.sat_data(sat_lon)[['x','y','z']])
+
+def test_reprocess_timestamps(tmp_path):
+    df = _measurements(12)
+    df['time'] = pd.to_datetime(df['time'], unit = 's', origin = '2024-01-01').dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    measurements, ephemeris = helpers.write_inputs(tmp_path, df)
+    summary = _job(measurements, ephemeris, str(tmp_path / 'store')).run()
+    # Windows of 40 s since the Unix epoch
+    first = pd.Timestamp('2024-01-01', tz = 'UTC').timestamp() // 40.0
+    assert summary['windows'] == [first, first + 1, first + 2]
+
+    df['time'] = 'yesterday'
+    measurements, ephemeris = helpers.write_inputs(tmp_path, df)
+    with pytest.raises(error_handling.InsufficientDataError):
+        _job(measurements, ephemeris, str(tmp_path / 'store2')).run()
+
+def test_reprocess_invalid_fix_id(tmp_path):
+    df = _measurements(4)
+    df['fix_id'] = ['a', 'b', 'c', 'd']
+    measurements, ephemeris = helpers.write_inputs(tmp_path, df)
+    with pytest.raises(error_handling.InsufficientDataError):
+        _job(measurements, ephemeris, str(tmp_path / 'store')).run()
+
+    df['fix_id'] = [0, 0, 1, 2]
+    measurements, ephemeris = helpers.write_inputs(tmp_path, df)
+    with pytest.raises(error_handling.InsufficientDataError):
+        _job(measurements, ephemeris, str(tmp_path / 'store2')).run()